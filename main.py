@@ -1,52 +1,89 @@
 #!/usr/bin/env python
 
-import json
+try:
+    from orjson import loads as _jloads
+except ImportError:
+    from json import loads as _jloads
+
 import os
+import select
+import signal
+import socket
 import subprocess
 import time
-from dataclasses import dataclass, fields
-from enum import StrEnum
-from typing import Callable, Iterator, List, Tuple
+from typing import Callable, Iterator, List, Tuple, TypedDict
 
 
 BAR_HEIGHT = int(os.getenv("WAYBAR_AUTOHIDE_BAR_HEIGHT", "50"))
 HEIGHT_THRESHOLD = int(os.getenv("WAYBAR_AUTOHIDE_HEIGHT_THRESHOLD", "20"))
 WAYBAR_PROC = os.getenv("WAYBAR_AUTOHIDE_PROCNAME", "waybar")
 
-
-class WaybarState(StrEnum):
-    VISIBLE = "1"
-    HIDDEN = "0"
-
-
-class BaseModel:
-    @classmethod
-    def model_validate(cls, data: dict):
-        field_names = {(f.name, f.type) for f in fields(cls)}
-        filtered_data = {}
-
-        for field_name, field_type in field_names:
-            if field_name not in data:
-                continue
-
-            if isinstance(field_type, type) and issubclass(field_type, BaseModel):
-                filtered_data[field_name] = field_type.model_validate(data[field_name])
-            elif isinstance(field_type, type):
-                filtered_data[field_name] = field_type(data[field_name])
-            else:
-                filtered_data[field_name] = data[field_name]
-
-        return cls(**filtered_data)
-
-
-@dataclass
-class Workspace(BaseModel):
+# Hyprland socket2 events that may change whether a window overlaps the bar
+HYPRLAND_EVENTS = frozenset(
+    {
+        "openwindow",
+        "closewindow",
+        "movewindow",
+        "movewindowv2",
+        "workspace",
+        "workspacev2",
+        "moveworkspace",
+        "moveworkspacev2",
+        "activewindow",
+        "fullscreen",
+        "changefloatingmode",
+        "minimized",
+    }
+)
+
+# Hyprland socket2 events that invalidate the cached monitor layout
+HYPRLAND_LAYOUT_EVENTS = frozenset(
+    {
+        "monitoradded",
+        "monitoraddedv2",
+        "monitorremoved",
+        "monitorremovedv2",
+        "configreloaded",
+    }
+)
+
+# Maximum age of the cached monitor layout when falling back to polling
+MONITORS_CACHE_TTL = 5.0
+
+# When falling back to polling, the refresh rate backs off up to MAX_REFRESH_RATE
+# while the bar is visible and the cursor is further than this from the top
+FAR_CURSOR_DISTANCE = BAR_HEIGHT * 4
+MAX_REFRESH_RATE = 2.0
+
+# Seconds spent suspended after which the state is checked again right away
+SUSPEND_THRESHOLD = 5.0
+
+# Seconds for waybar to apply a toggle before its reserved area is read back
+TOGGLE_SETTLE_TIME = 1.0
+
+_WAYBAR_PIDS: list[int] = []
+
+# Opened once and shared by subprocess calls instead of subprocess.DEVNULL,
+# which opens /dev/null again on each call
+_DEVNULL_FD = os.open(os.devnull, os.O_WRONLY)
+
+_MONITORS_CACHE: list[tuple[int, int, int, int, int]] | None = None
+
+# Areas reserved on the monitors, as last observed with waybar in each state
+_RESERVED_BY_STATE: dict[bool, tuple] = {}
+_MONITORS_CACHE_TIME = 0.0
+
+
+# Waybar visibility states
+VISIBLE, HIDDEN = True, False
+
+
+class Workspace(TypedDict):
     id: int
     name: str
 
 
-@dataclass
-class HyprlandClient(BaseModel):
+class HyprlandClient(TypedDict):
     address: str
     mapped: bool
     hidden: bool
@@ -59,132 +96,470 @@ class HyprlandClient(BaseModel):
     fullscreen: int
 
 
-def is_waybar_running() -> bool:
+def get_waybar_pids() -> list[int]:
     result = subprocess.run(
         ["pgrep", "-x", WAYBAR_PROC],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=_DEVNULL_FD,
+        text=True,
     )
-    return result.returncode == 0
+    return [int(pid) for pid in result.stdout.split()]
+
+
+def is_waybar_running() -> bool:
+    global _WAYBAR_PIDS
+
+    _WAYBAR_PIDS = get_waybar_pids()
+    return bool(_WAYBAR_PIDS)
 
 
 def is_hyprland_running() -> bool:
-    result = subprocess.run(
-        ["hyprctl", "version"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-    return result.returncode == 0
+    try:
+        hypr_ipc(b"version")
+    except (KeyError, OSError):
+        return False
+    return True
+
+
+def signal_waybar(pid: int) -> bool:
+    """
+    Sends SIGUSR1 to `pid` if it is still a waybar process, returning whether it
+    was signaled. A cached pid may have been recycled by an unrelated process,
+    which SIGUSR1 would terminate.
+    """
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            # The kernel truncates comm to 15 characters, as pgrep -x matches it
+            if f.read().rstrip("\n") != WAYBAR_PROC[:15]:
+                return False
+        os.kill(pid, signal.SIGUSR1)
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return False
 
+    return True
 
-def toggle_waybar_visibility():
-    subprocess.run(["pkill", "-USR1", WAYBAR_PROC], check=False)
 
+def toggle_waybar_visibility() -> bool:
+    """
+    Toggles every known waybar instance, returning whether new instances were
+    found instead. Those start visible and are left untouched, so the caller can
+    reset its state rather than toggling them from a stale one.
+    """
+    global _WAYBAR_PIDS
 
-def get_current_workspace() -> list[int]:
-    workspaces = subprocess.check_output(
-        "hyprctl monitors -j | jq '.[] | .activeWorkspace.id'",
-        shell=True,
-        text=True,
-    )
-    return [int(workspace.strip()) for workspace in workspaces.strip().split("\n")]
+    signaled = {pid for pid in _WAYBAR_PIDS if signal_waybar(pid)}
+
+    if signaled and len(signaled) == len(_WAYBAR_PIDS):
+        return False
 
+    # Waybar was restarted, look it up again
+    _WAYBAR_PIDS = get_waybar_pids()
+    return any(pid not in signaled for pid in _WAYBAR_PIDS)
 
-def get_monitor_from_position(pos_x: int, pos_y: int) -> int | None:
-    monitors = json.loads(subprocess.check_output(["hyprctl", "-j", "monitors"]))
 
-    for monitor in monitors:
-        start_x, end_x = monitor["x"], monitor["x"] + monitor["width"]
-        start_y, end_y = monitor["y"], monitor["y"] + monitor["height"]
+def get_hyprland_socket_path(name: str) -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")
+    signature = os.environ["HYPRLAND_INSTANCE_SIGNATURE"]
+    return os.path.join(runtime_dir, "hypr", signature, name)
+
+
+def hypr_ipc(command: bytes) -> bytes:
+    """
+    Sends a request to Hyprland's control socket, the same way hyprctl does, and
+    returns the raw reply. The socket serves a single request per connection.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(get_hyprland_socket_path(".socket.sock"))
+        sock.sendall(command)
+        return b"".join(iter(lambda: sock.recv(8192), b""))
+
 
+class HyprlandEvents:
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._buffer = b""
+
+    @classmethod
+    def connect(cls) -> "HyprlandEvents | None":
+        try:
+            path = get_hyprland_socket_path(".socket2.sock")
+        except KeyError:
+            return None
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+
+        return cls(sock)
+
+    def wait(self, timeout: float | None = None) -> set[str]:
+        """
+        Blocks until Hyprland emits events or the timeout expires, returning the
+        names of the events received (an empty set on timeout).
+        """
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        if not readable:
+            return set()
+
+        chunk = self._sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("Hyprland event socket closed")
+
+        *lines, self._buffer = (self._buffer + chunk).split(b"\n")
+
+        events = set()
+        for line in lines:
+            event, _, _data = line.partition(b">>")
+            events.add(event.decode())
+
+        return events
+
+
+def fetch_state_batch() -> tuple[list[dict], list[HyprlandClient], tuple[int, int]]:
+    """
+    Fetches monitors, clients and the cursor position with a single batch request.
+    """
+    output = hypr_ipc(b"[[BATCH]]j/monitors;j/clients;j/cursorpos")
+
+    # Hyprland joins batch replies with three newlines, which can't occur inside
+    # JSON since newlines in strings are escaped
+    monitors, clients, cursor = map(_jloads, output.split(b"\n\n\n"))
+    return monitors, clients, (int(cursor["x"]), int(cursor["y"]))
+
+
+def get_current_workspace(monitors: list[dict] | None = None) -> list[int]:
+    if monitors is None:
+        monitors = _jloads(hypr_ipc(b"j/monitors"))
+    return [int(m["activeWorkspace"]["id"]) for m in monitors]
+
+
+def get_monitor_layout() -> list[tuple[int, int, int, int, int]]:
+    global _MONITORS_CACHE, _MONITORS_CACHE_TIME
+
+    if _MONITORS_CACHE is None:
+        monitors = _jloads(hypr_ipc(b"j/monitors"))
+        _MONITORS_CACHE = [
+            (
+                int(m["id"]),
+                m["x"],
+                m["y"],
+                m["x"] + m["width"],
+                m["y"] + m["height"],
+            )
+            for m in monitors
+        ]
+        _MONITORS_CACHE_TIME = time.monotonic()
+
+    return _MONITORS_CACHE
+
+
+def invalidate_monitor_layout(max_age: float | None = None):
+    """
+    Drops the cached monitor layout, or only if it is older than `max_age` seconds.
+    """
+    global _MONITORS_CACHE
+
+    if max_age is None or time.monotonic() - _MONITORS_CACHE_TIME > max_age:
+        _MONITORS_CACHE = None
+
+
+def get_monitor_from_position(pos_x: int, pos_y: int) -> int | None:
+    for monitor_id, start_x, start_y, end_x, end_y in get_monitor_layout():
         if pos_x < start_x or pos_x > end_x:
             continue
 
         if pos_y < start_y or pos_y > end_y:
             continue
 
-        return int(monitor["id"])
+        return monitor_id
 
     return None
 
 
 def get_clients(
     filter_func: Callable[[HyprlandClient], bool] | None = None,
+    clients: list[HyprlandClient] | None = None,
 ) -> Iterator[HyprlandClient]:
-    clients = [
-        HyprlandClient.model_validate(c)
-        for c in json.loads(subprocess.check_output(["hyprctl", "-j", "clients"]))
-    ]
+    if clients is None:
+        clients = _jloads(hypr_ipc(b"j/clients"))
+
     for c in clients:
         if filter_func is None or filter_func(c):
             yield c
 
 
+def overlaps_bar(
+    c: HyprlandClient,
+    workspace_ids: frozenset[int],
+    monitor_ids: frozenset[int] | None,
+) -> bool:
+    if not c["mapped"] or c["hidden"] or c["fullscreen"]:
+        return False
+    if monitor_ids is not None and c["monitor"] not in monitor_ids:
+        return False
+    if c["workspace"]["id"] not in workspace_ids:
+        return False
+
+    y = c["at"][1]
+    h = c["size"][1]
+
+    return y < (BAR_HEIGHT + HEIGHT_THRESHOLD) and (y + h) > 0
+
+
+def get_overlap_filter_ids(
+    active_workspaces: list[int], monitors: list[int] | None
+) -> tuple[frozenset[int], frozenset[int] | None]:
+    # Special workspaces have negative ids, so sets are used instead of bitmasks
+    workspace_ids = frozenset(active_workspaces)
+    monitor_ids = frozenset(monitors) if monitors else None
+    return workspace_ids, monitor_ids
+
+
 def get_overlapping_clients(
     active_workspaces: list[int],
     monitors: list[int] | None = None,
+    clients: list[HyprlandClient] | None = None,
 ) -> Iterator[HyprlandClient]:
-    def overlaps_bar(c: HyprlandClient) -> bool:
-        if not c.mapped:
-            return False
-        if c.hidden:
-            return False
-        if c.fullscreen:
-            return False
-        if c.monitor not in (monitors or [c.monitor]):
-            return False
-        if c.workspace.id not in active_workspaces:
-            return False
+    if clients is None:
+        clients = _jloads(hypr_ipc(b"j/clients"))
 
-        x, y = c.at
-        w, h = c.size
+    workspace_ids, monitor_ids = get_overlap_filter_ids(active_workspaces, monitors)
 
-        return y < (BAR_HEIGHT + HEIGHT_THRESHOLD) and (y + h) > 0
-
-    return get_clients(overlaps_bar)
+    for c in clients:
+        if overlaps_bar(c, workspace_ids, monitor_ids):
+            yield c
 
 
 def window_overlaps_bar(
-    active_workspaces: list[int], monitors: List[int] | None = None
+    active_workspaces: list[int],
+    monitors: List[int] | None = None,
+    clients: list[HyprlandClient] | None = None,
 ) -> bool:
-    return any(get_overlapping_clients(active_workspaces, monitors))
+    if clients is None:
+        clients = _jloads(hypr_ipc(b"j/clients"))
+
+    workspace_ids, monitor_ids = get_overlap_filter_ids(active_workspaces, monitors)
+
+    # Loops directly rather than through get_overlapping_clients to avoid
+    # resuming a generator for every client
+    for c in clients:
+        if overlaps_bar(c, workspace_ids, monitor_ids):
+            return True
+
+    return False
 
 
 def get_cursor_position() -> Tuple[int, int]:
-    output = subprocess.check_output(["hyprctl", "cursorpos"]).decode()
-    pos_x, pos_y = output.strip().split(",")
-    return int(pos_x.strip()), int(pos_y.strip())
+    # int() accepts bytes and ignores surrounding whitespace, e.g. b"1234, 56\n"
+    pos_x, _, pos_y = hypr_ipc(b"cursorpos").partition(b",")
+    return int(pos_x), int(pos_y)
 
 
 def cursor_aproaches_bar(
-    monitors: list[int] | None, current_state: WaybarState
+    monitors: list[int] | None,
+    current_state: bool,
+    position: Tuple[int, int] | None = None,
 ) -> bool:
-    x, y = get_cursor_position()
+    x, y = position if position is not None else get_cursor_position()
 
     cursor_monitor = get_monitor_from_position(x, y)
-    if cursor_monitor is None or cursor_monitor not in (monitors or [cursor_monitor]):
+    if cursor_monitor is None:
+        return False
+    if monitors and cursor_monitor not in monitors:
         return False
 
-    offset = BAR_HEIGHT if current_state == WaybarState.VISIBLE else 0
+    offset = BAR_HEIGHT if current_state is VISIBLE else 0
 
     return y <= offset
 
 
+def notify_systemd(state: str):
+    """
+    Sends a sd_notify(3) state string to the service manager, if any.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.sendall(state.encode())
+
+
+def needs_cursor_poll(monitors: list[int] | None, current_state: bool) -> bool:
+    # With no overlapping window the bar stays visible regardless of the cursor,
+    # so the cursor only has to be tracked while it is hidden or being revealed.
+    if current_state is HIDDEN:
+        return True
+
+    return cursor_aproaches_bar(monitors, current_state)
+
+
+def cursor_changes_state(monitors: list[int] | None, current_state: bool) -> bool:
+    # While no window changes, a hidden bar can only be revealed by the cursor and
+    # a bar revealed by the cursor can only hide once the cursor leaves it.
+    approaches = cursor_aproaches_bar(monitors, current_state)
+    return approaches != current_state
+
+
+def reconcile_state(monitors: list[dict], current_state: bool, learn: bool) -> bool:
+    """
+    Returns waybar's actual state, told apart by the area reserved on the
+    monitors since hiding waybar drops its exclusive zone. With `learn`, the
+    current state is trusted and its reserved area recorded instead.
+
+    The areas are compared as a whole rather than expecting a given value, so
+    other panels and bars without an exclusive zone don't mislead it.
+    """
+    reserved = tuple(tuple(m["reserved"]) for m in monitors)
+
+    if learn:
+        _RESERVED_BY_STATE[current_state] = reserved
+        return current_state
+
+    matches = [s for s, r in _RESERVED_BY_STATE.items() if r == reserved]
+    if len(matches) == 1 and len(_RESERVED_BY_STATE) == 2:
+        return matches[0]
+
+    return current_state
+
+
 def get_next_state(
-    waybar_monitors: list[int], current_state: WaybarState
-) -> WaybarState:
-    cursor_aproaches = cursor_aproaches_bar(waybar_monitors, current_state)
+    waybar_monitors: list[int] | None,
+    current_state: bool,
+    batch: tuple[list[dict], list[HyprlandClient], tuple[int, int]] | None = None,
+) -> bool:
+    monitors, clients, position = batch if batch is not None else fetch_state_batch()
+
+    cursor_aproaches = cursor_aproaches_bar(waybar_monitors, current_state, position)
 
     if cursor_aproaches:
-        return WaybarState.VISIBLE
+        return VISIBLE
 
-    active_workspaces = get_current_workspace()
-    overlaps = window_overlaps_bar(active_workspaces, waybar_monitors)
+    active_workspaces = get_current_workspace(monitors)
+    overlaps = window_overlaps_bar(active_workspaces, waybar_monitors, clients)
 
     if overlaps:
-        return WaybarState.HIDDEN
+        return HIDDEN
+
+    return VISIBLE
+
+
+def get_clocks() -> tuple[float, float]:
+    return time.clock_gettime(time.CLOCK_BOOTTIME), time.monotonic()
+
 
-    return WaybarState.VISIBLE
+def was_suspended(since: tuple[float, float]) -> bool:
+    # CLOCK_BOOTTIME keeps counting while suspended and the monotonic clock
+    # doesn't, so the difference of their deltas is the time spent suspended
+    boottime, monotonic = get_clocks()
+    return (boottime - since[0]) - (monotonic - since[1]) > SUSPEND_THRESHOLD
+
+
+def wait_for_events(
+    events: HyprlandEvents,
+    monitors: list[int] | None,
+    current_state: bool,
+    refresh_rate: float,
+):
+    """
+    Blocks until a Hyprland event or the cursor may change the bar state.
+    """
+    poll_cursor = needs_cursor_poll(monitors, current_state)
+    # A deadline rather than a fixed timeout, so a stream of unrelated events
+    # (e.g. windowtitle) can't keep postponing the cursor check
+    deadline = time.monotonic() + refresh_rate
+    clocks = get_clocks()
+
+    while True:
+        timeout = max(deadline - time.monotonic(), 0.0) if poll_cursor else None
+
+        received = events.wait(timeout)
+        if received & HYPRLAND_LAYOUT_EVENTS:
+            invalidate_monitor_layout()
+            return
+        if received & HYPRLAND_EVENTS:
+            return
+
+        if poll_cursor and time.monotonic() >= deadline:
+            # Waybar may have been toggled or restarted while suspended
+            if was_suspended(clocks):
+                return
+            if cursor_changes_state(monitors, current_state):
+                return
+            deadline = time.monotonic() + refresh_rate
+
+
+def wait_polling(
+    monitors: list[int] | None,
+    current_state: bool,
+    delay: float,
+    refresh_rate: float,
+) -> float:
+    """
+    Sleeps until the next full state check when the event socket is unavailable,
+    returning the delay to use before the following one.
+    """
+    clocks = get_clocks()
+    while True:
+        time.sleep(delay)
+        invalidate_monitor_layout(MONITORS_CACHE_TTL)
+
+        if current_state is not VISIBLE or was_suspended(clocks):
+            return refresh_rate
+
+        position = get_cursor_position()
+        if position[1] > FAR_CURSOR_DISTANCE:
+            return min(delay * 1.5, MAX_REFRESH_RATE)
+        if not cursor_aproaches_bar(monitors, current_state, position):
+            return refresh_rate
+
+        # The cursor keeps the bar visible, so the windows don't need checking
+        delay = refresh_rate
+
+
+def run(
+    events: HyprlandEvents | None,
+    waybar_monitors: list[int] | None,
+    state: bool,
+    refresh_rate: float,
+):
+    delay = refresh_rate
+    # The starting state is trusted until a reserved area is recorded for it
+    learn = True
+    last_toggle = float("-inf")
+    while True:
+        batch = fetch_state_batch()
+
+        # Catches waybar being toggled behind our back, e.g. by a user keybind
+        if time.monotonic() - last_toggle >= TOGGLE_SETTLE_TIME:
+            state = reconcile_state(batch[0], state, learn)
+            learn = False
+
+        next_state = get_next_state(waybar_monitors, state, batch)
+        if next_state != state:
+            if toggle_waybar_visibility():
+                # A restarted waybar comes back visible, re-evaluate from there
+                state = VISIBLE
+                learn = True
+                last_toggle = time.monotonic()
+                continue
+            state = next_state
+            delay = refresh_rate
+            learn = True
+            last_toggle = time.monotonic()
+
+        if events is None:
+            delay = wait_polling(waybar_monitors, state, delay, refresh_rate)
+            continue
+
+        wait_for_events(events, waybar_monitors, state, refresh_rate)
 
 
 def main():
@@ -192,29 +567,35 @@ def main():
     if waybar_monitors is not None:
         waybar_monitors = waybar_monitors.split(",")
         waybar_monitors = [int(m.strip()) for m in waybar_monitors if m.strip()]
-    else:
-        waybar_monitors = []
 
-    state: WaybarState = WaybarState(os.environ.get("WAYBAR_AUTOHIDE_STATE", "1"))
+    # An empty monitor list enables auto-hide on every monitor
+    waybar_monitors = waybar_monitors or None
+
+    state: bool = os.environ.get("WAYBAR_AUTOHIDE_STATE", "1") == "1"
 
     refresh_rate = float(os.environ.get("WAYBAR_AUTOHIDE_REFRESH_RATE", "0.5"))
 
     if not is_waybar_running():
         print("Waybar is not running. Exiting.")
-        return
+        return 1
 
     if not is_hyprland_running():
         print("Hyprland is not running. Exiting.")
-        return
+        return 1
 
-    while True:
-        next_state = get_next_state(waybar_monitors, state)
-        if next_state != state:
-            toggle_waybar_visibility()
-            state = next_state
+    events = HyprlandEvents.connect()
+    if events is None:
+        print("Hyprland event socket unavailable. Falling back to polling.")
+
+    notify_systemd("READY=1")
 
-        time.sleep(refresh_rate)
+    try:
+        run(events, waybar_monitors, state, refresh_rate)
+    except OSError as e:
+        # Hyprland closed the event socket or stopped answering, e.g. on exit
+        print(f"Lost connection to Hyprland: {e}. Exiting.")
+        return 1
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())